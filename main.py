@@ -1,31 +1,93 @@
 from __future__ import annotations
 
 import logging
-from enum import Enum
-from typing import Any, Dict, Optional
-
+import os
+import uuid
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+import msgspec
+import redis.asyncio as redis
+from cachetools import TTLCache
 from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse, JSONResponse
-from pydantic import BaseModel, Field
+from fastapi.responses import HTMLResponse, Response
+from pydantic import BaseModel, ConfigDict, Field
+
+from policy_core import next_reply
+from session_state import SessionStateDC, Step
 
 
 # ---------------------------
-# State machine models
+# Wire models
 # ---------------------------
 
-class Step(str, Enum):
-    LIMITED_RESPONSE = "LIMITED_RESPONSE"
-    COLLECT_CONTACT = "COLLECT_CONTACT"
-    HANDOFF = "HANDOFF"
+# Wire types: msgspec decodes requests and encodes responses in one C pass.
+# omit_defaults drops unset optionals (early-session contact fields,
+# procedure/intent) from the response payload.
+class IncomingWire(msgspec.Struct):
+    session_id: str
+    user_message: str
+    channel: str = "webchat"
+    practice_name: str = "Example Dental Clinic"
+    prior_state: Optional[SessionStateDC] = None
+    msg: Optional[str] = None
+    state: Optional[SessionStateDC] = None
+
+
+class CollectedWire(msgspec.Struct, omit_defaults=True):
+    name: Optional[str] = None
+    phone: Optional[str] = None
+    best_time: Optional[str] = None
+
+
+class SessionStateWire(msgspec.Struct, omit_defaults=True):
+    step: Step
+    collected: CollectedWire
+    procedure: Optional[str] = None
+    intent: Optional[str] = None
+
+
+class OutgoingWire(msgspec.Struct, omit_defaults=True):
+    session_id: str
+    channel: str
+    practice_name: str
+    user_message: str
+    reply: str
+    state: SessionStateWire
+
+
+def state_to_wire(s: SessionStateDC) -> SessionStateWire:
+    c = s.collected
+    return SessionStateWire(
+        step=s.step,
+        collected=CollectedWire(c.name, c.phone, c.best_time),
+        procedure=s.procedure,
+        intent=s.intent,
+    )
+
+
+INCOMING_DECODER = msgspec.json.Decoder(IncomingWire)
+STATE_DECODER = msgspec.json.Decoder(SessionStateDC)
+JSON_ENCODER = msgspec.json.Encoder()
+
 
+def json_response(content: object, status_code: int = 200) -> Response:
+    return Response(content=JSON_ENCODER.encode(content), status_code=status_code, media_type="application/json")
 
+
+# OpenAPI-facing schema only; requests and responses go through the wire
+# types above.
 class Collected(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     name: Optional[str] = None
     phone: Optional[str] = None
     best_time: Optional[str] = None
 
 
 class SessionState(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     step: Step = Step.LIMITED_RESPONSE
     procedure: Optional[str] = None
     intent: Optional[str] = None
@@ -33,6 +95,8 @@ class SessionState(BaseModel):
 
 
 class IncomingMessage(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     session_id: str
     user_message: str
     channel: str = "webchat"
@@ -43,6 +107,8 @@ class IncomingMessage(BaseModel):
 
 
 class OutgoingMessage(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+
     session_id: str
     channel: str
     practice_name: str
@@ -51,143 +117,91 @@ class OutgoingMessage(BaseModel):
     state: SessionState
 
 
-# ---------------------------
-# App + error handler
-# ---------------------------
+class DecodeErrorResponse(BaseModel):
+    """422 body for an invalid /webchat/message request: msgspec's message."""
 
-app = FastAPI(title="Policy+StateMachine Demo Backend", version="0.2.0")
+    detail: str
 
 
-@app.exception_handler(Exception)
-async def unhandled_exception_handler(request: Request, exc: Exception):
-    logging.exception("Unhandled server error")
-    return JSONResponse(status_code=500, content={"error": "internal_error", "detail": str(exc)})
+# Nested models resolve against the components FastAPI registers for
+# OutgoingMessage.
+INCOMING_SCHEMA = IncomingMessage.model_json_schema(ref_template="#/components/schemas/{model}")
+INCOMING_SCHEMA.pop("$defs", None)
 
 
 # ---------------------------
-# In-memory session store
+# App + error handler
 # ---------------------------
 
-SESSION_DB: Dict[str, SessionState] = {}
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    yield
+    if REDIS is not None:
+        await REDIS.aclose()
 
 
-def get_state(payload: IncomingMessage) -> SessionState:
-    if payload.state is not None:
-        return payload.state
-    if payload.prior_state is not None:
-        return payload.prior_state
-    if payload.session_id in SESSION_DB:
-        return SESSION_DB[payload.session_id]
-    return SessionState()
+app = FastAPI(
+    title="Policy+StateMachine Demo Backend",
+    version="0.2.0",
+    lifespan=lifespan,
+)
 
 
-def save_state(session_id: str, state: SessionState) -> None:
-    SESSION_DB[session_id] = state
+@app.exception_handler(Exception)
+async def unhandled_exception_handler(request: Request, exc: Exception) -> Response:
+    # str(exc) may embed user data, so the client only gets an id to quote;
+    # the traceback is in the log under the same id.
+    error_id = uuid.uuid4().hex
+    logging.exception("Unhandled server error (error_id=%s)", error_id)
+    return json_response({"error": "internal_error", "error_id": error_id}, status_code=500)
 
 
 # ---------------------------
-# Policy layer
+# Session store
 # ---------------------------
 
-def is_medical_or_medication_question(text: str) -> bool:
-    t = text.lower()
-    keywords = [
-        "antibiotic", "antibiotics", "amoxicillin", "penicillin", "clindamycin",
-        "medicine", "medication", "dose", "dosage", "should i",
-        "ibuprofen", "painkiller", "prescription",
-    ]
-    return any(k in t for k in keywords)
-
-
-def limited_response_policy(practice_name: str) -> str:
-    return (
-        f"Thanks for your question. I can’t recommend specific medication (including antibiotics) "
-        f"without a clinician evaluating your situation.\n\n"
-        f"If you have severe swelling, fever, trouble swallowing/breathing, or rapidly worsening pain, "
-        f"please seek urgent care immediately.\n\n"
-        f"If not urgent: the safest next step is to speak with a dentist from {practice_name}. "
-        f"Can I take your **name** and **phone number**, and the **best time** to call you back?"
-    )
+# Set REDIS_URL to share sessions across workers; without it sessions live in
+# a process-local LRU+TTL cache (fine for a single worker).
+REDIS_URL = os.environ.get("REDIS_URL")
+SESSION_TTL_SECONDS = int(os.environ.get("SESSION_TTL_SECONDS", "3600"))
+SESSION_CACHE_MAXSIZE = int(os.environ.get("SESSION_CACHE_MAXSIZE", "100000"))
 
+REDIS: Optional[redis.Redis] = redis.Redis.from_url(REDIS_URL) if REDIS_URL else None
+SESSION_DB: TTLCache[str, SessionStateDC] = TTLCache(maxsize=SESSION_CACHE_MAXSIZE, ttl=SESSION_TTL_SECONDS)
 
-# ---------------------------
-# Extraction (hardened)
-# ---------------------------
 
-def update_collected_from_text(state: SessionState, user_text: str) -> SessionState:
-    if state.collected is None:
-        state.collected = Collected()
+def session_key(session_id: str) -> str:
+    return f"sess:{session_id}"
 
-    text = user_text.strip()
-    t = text.lower()
 
-    # Phone: naive parse
-    digits = "".join(ch for ch in text if ch.isdigit() or ch == "+")
-    if len(digits.replace("+", "")) >= 9 and not state.collected.phone:
-        state.collected.phone = digits
+async def load_state(session_id: str) -> SessionStateDC:
+    if REDIS is not None:
+        raw = await REDIS.get(session_key(session_id))
+        if raw is None:
+            return SessionStateDC()
+        try:
+            return STATE_DECODER.decode(raw)
+        except msgspec.DecodeError:
+            # Corrupt or schema-incompatible entry: start the session over.
+            logging.warning("Discarding undecodable session state for %s", session_id)
+            return SessionStateDC()
+    # Stored states were validated on the way in; return as-is. Single get()
+    # so an entry expiring between check and read can't KeyError.
+    return SESSION_DB.get(session_id) or SessionStateDC()
 
-    # Best time: naive phrases
-    if not state.collected.best_time and any(x in t for x in ["morning", "afternoon", "evening", "today", "tomorrow", "anytime"]):
-        state.collected.best_time = text
 
-    # Name: case-safe, no split indexing
-    if not state.collected.name:
-        patterns = ["my name is ", "i am ", "i'm "]
-        for pat in patterns:
-            idx = t.find(pat)
-            if idx != -1:
-                name = text[idx + len(pat):].strip()
-                for stop in [".", ",", ";", " and "]:
-                    if stop in name:
-                        name = name.split(stop, 1)[0].strip()
-                if len(name) >= 2:
-                    state.collected.name = name[:80]
-                break
+async def save_state(session_id: str, state: SessionStateDC) -> None:
+    if REDIS is not None:
+        await REDIS.set(session_key(session_id), JSON_ENCODER.encode(state), ex=SESSION_TTL_SECONDS)
+    else:
+        SESSION_DB[session_id] = state
 
-    return state
 
-
-# ---------------------------
-# State machine
-# ---------------------------
-
-def next_reply(practice_name: str, user_text: str, state: SessionState) -> tuple[str, SessionState]:
-    if is_medical_or_medication_question(user_text):
-        state.step = Step.LIMITED_RESPONSE
-        return limited_response_policy(practice_name), state
-
-    if state.step in (Step.LIMITED_RESPONSE, Step.COLLECT_CONTACT):
-        state = update_collected_from_text(state, user_text)
-
-        missing = []
-        if not state.collected.name:
-            missing.append("name")
-        if not state.collected.phone:
-            missing.append("phone number")
-        if not state.collected.best_time:
-            missing.append("best time to call")
-
-        if missing:
-            state.step = Step.COLLECT_CONTACT
-            return (
-                "To arrange a callback, I still need your " + ", ".join(missing) +
-                ". You can reply in one message like: “My name is …, phone …, best time …”.",
-                state,
-            )
-
-        state.step = Step.HANDOFF
-        return (
-            f"Thanks, {state.collected.name}. I’ve captured your details.\n\n"
-            f"Phone: {state.collected.phone}\n"
-            f"Best time: {state.collected.best_time}\n\n"
-            f"Someone from {practice_name} will contact you.",
-            state,
-        )
-
-    return (
-        f"Thanks — your request is with the team at {practice_name}.",
-        state,
-    )
+async def delete_state(session_id: str) -> None:
+    if REDIS is not None:
+        await REDIS.delete(session_key(session_id))
+    else:
+        SESSION_DB.pop(session_id, None)
 
 
 # ---------------------------
@@ -195,37 +209,74 @@ def next_reply(practice_name: str, user_text: str, state: SessionState) -> tuple
 # ---------------------------
 
 @app.get("/health")
-def health() -> Dict[str, str]:
-    return {"status": "ok"}
-
-
-@app.post("/webchat/message", response_model=OutgoingMessage)
-def webchat_message(payload: IncomingMessage) -> OutgoingMessage:
-    state = get_state(payload)
+async def health() -> Response:
+    return json_response({"status": "ok"})
+
+
+# Decodes/encodes with msgspec directly, so FastAPI runs neither request
+# validation nor jsonable_encoder; openapi_extra/responses keep the pydantic
+# schema in the docs.
+@app.post(
+    "/webchat/message",
+    openapi_extra={"requestBody": {"required": True, "content": {"application/json": {"schema": INCOMING_SCHEMA}}}},
+    responses={200: {"model": OutgoingMessage}, 422: {"model": DecodeErrorResponse}},
+)
+async def webchat_message(request: Request) -> Response:
+    try:
+        payload = INCOMING_DECODER.decode(await request.body())
+    except msgspec.DecodeError as exc:
+        return json_response({"detail": str(exc)}, status_code=422)
+    state = payload.state or payload.prior_state or await load_state(payload.session_id)
     reply, new_state = next_reply(payload.practice_name, payload.user_message, state)
-    save_state(payload.session_id, new_state)
+    await save_state(payload.session_id, new_state)
 
-    return OutgoingMessage(
+    out = OutgoingWire(
         session_id=payload.session_id,
         channel=payload.channel,
         practice_name=payload.practice_name,
         user_message=payload.user_message,
         reply=reply,
-        state=new_state,
+        state=state_to_wire(new_state),
     )
+    return Response(content=JSON_ENCODER.encode(out), media_type="application/json")
 
 
 @app.post("/admin/reset_session/{session_id}")
-def reset_session(session_id: str) -> Dict[str, Any]:
-    SESSION_DB.pop(session_id, None)
-    return {"ok": True, "session_id": session_id}
+async def reset_session(session_id: str) -> Response:
+    await delete_state(session_id)
+    return json_response({"ok": True, "session_id": session_id})
 
 
-# Chat UI (serves chat.html if present)
-@app.get("/", response_class=HTMLResponse)
-def home():
+# Chat UI (serves chat.html if present, read once at import)
+def _load_chat_html() -> bytes:
     try:
-        with open("chat.html", "r", encoding="utf-8") as f:
+        with open("chat.html", "rb") as f:
             return f.read()
     except FileNotFoundError:
-        return "<h3>chat.html not found</h3><p>Create chat.html next to main.py.</p>"
+        return b"<h3>chat.html not found</h3><p>Create chat.html next to main.py.</p>"
+
+
+CHAT_HTML = _load_chat_html()
+
+
+@app.get("/", response_class=HTMLResponse)
+async def home() -> HTMLResponse:
+    return HTMLResponse(CHAT_HTML)
+
+
+# Run with uvloop + httptools. One worker per core when REDIS_URL is set;
+# otherwise a single worker, since each process would get its own SESSION_DB.
+# WEB_CONCURRENCY overrides either default. For gunicorn:
+#   gunicorn main:app -k uvicorn.workers.UvicornWorker --worker-connections 1000
+if __name__ == "__main__":
+    import uvicorn
+
+    default_workers = (os.cpu_count() or 2) if REDIS_URL else 1
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=int(os.environ.get("PORT", "8000")),
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.environ.get("WEB_CONCURRENCY", default_workers)),
+    )
@@ -0,0 +1,161 @@
+"""Policy layer and state machine for the webchat backend.
+
+Pure, typed Python with no web/IO dependencies so it can be compiled
+ahead-of-time with mypyc (``mypyc policy_core.py``); main.py imports the
+compiled extension when present and this source otherwise. The state types
+live in session_state.py, which stays interpreted: mypyc-native classes drop
+their field annotations, which msgspec needs to decode into them.
+"""
+
+from functools import lru_cache
+from typing import Callable, Dict, Optional
+
+from session_state import CollectedDC, SessionStateDC, Step
+
+
+# ---------------------------
+# Policy layer
+# ---------------------------
+
+# Substring scans over one lower-cased copy; measured faster than an
+# IGNORECASE alternation regex on typical chat-length messages.
+MEDICAL_KEYWORDS = (
+    "antibiotic", "antibiotics", "amoxicillin", "penicillin", "clindamycin",
+    "medicine", "medication", "dose", "dosage", "should i",
+    "ibuprofen", "painkiller", "prescription",
+)
+
+
+def is_medical_or_medication_question(text: str) -> bool:
+    t = text.lower()
+    return any(k in t for k in MEDICAL_KEYWORDS)
+
+
+# Replies that depend only on practice_name are built once per name.
+@lru_cache(maxsize=128)
+def limited_response_policy(practice_name: str) -> str:
+    return (
+        f"Thanks for your question. I can’t recommend specific medication (including antibiotics) "
+        f"without a clinician evaluating your situation.\n\n"
+        f"If you have severe swelling, fever, trouble swallowing/breathing, or rapidly worsening pain, "
+        f"please seek urgent care immediately.\n\n"
+        f"If not urgent: the safest next step is to speak with a dentist from {practice_name}. "
+        f"Can I take your **name** and **phone number**, and the **best time** to call you back?"
+    )
+
+
+# ---------------------------
+# Extraction (hardened)
+# ---------------------------
+
+BEST_TIME_PHRASES = ("morning", "afternoon", "evening", "today", "tomorrow", "anytime")
+
+NAME_PREFIXES = ("my name is ", "i am ", "i'm ")
+NAME_STOPS = (".", ",", ";", " and ")
+
+
+def update_collected_from_text(state: SessionStateDC, user_text: str) -> SessionStateDC:
+    text = user_text.strip()
+    t = text.lower()
+
+    # Phone: naive parse
+    digits = "".join(ch for ch in text if ch.isdigit() or ch == "+")
+    if len(digits.replace("+", "")) >= 9 and not state.collected.phone:
+        state.collected.phone = digits
+
+    # Best time: naive phrases
+    if not state.collected.best_time and any(x in t for x in BEST_TIME_PHRASES):
+        state.collected.best_time = text
+
+    # Name: case-safe, no split indexing
+    if not state.collected.name:
+        for pat in NAME_PREFIXES:
+            idx = t.find(pat)
+            if idx != -1:
+                name = text[idx + len(pat):].strip()
+                for stop in NAME_STOPS:
+                    if stop in name:
+                        name = name.split(stop, 1)[0].strip()
+                if len(name) >= 2:
+                    state.collected.name = name[:80]
+                break
+
+    return state
+
+
+# ---------------------------
+# State machine
+# ---------------------------
+
+# Indexed by a 3-bit mask of missing slots (name=4, phone=2, best_time=1);
+# entry 0 (nothing missing) is None.
+MISSING_PROMPTS: list[Optional[str]] = [
+    None,
+    "best time to call",
+    "phone number",
+    "phone number, best time to call",
+    "name",
+    "name, best time to call",
+    "name, phone number",
+    "name, phone number, best time to call",
+]
+
+
+# Full collect prompts, built once per mask (including the all-missing prompt
+# every fresh session gets).
+COLLECT_PROMPTS: list[Optional[str]] = [
+    None if missing is None else (
+        "To arrange a callback, I still need your " + missing +
+        ". You can reply in one message like: “My name is …, phone …, best time …”."
+    )
+    for missing in MISSING_PROMPTS
+]
+
+
+def missing_prompt(collected: CollectedDC) -> Optional[str]:
+    mask = (not collected.name) << 2 | (not collected.phone) << 1 | (not collected.best_time)
+    return COLLECT_PROMPTS[mask]
+
+
+def handle_collect(practice_name: str, user_text: str, state: SessionStateDC) -> tuple[str, SessionStateDC]:
+    state = update_collected_from_text(state, user_text)
+
+    prompt = missing_prompt(state.collected)
+    if prompt is not None:
+        state.step = Step.COLLECT_CONTACT
+        return prompt, state
+
+    state.step = Step.HANDOFF
+    return (
+        f"Thanks, {state.collected.name}. I’ve captured your details.\n\n"
+        f"Phone: {state.collected.phone}\n"
+        f"Best time: {state.collected.best_time}\n\n"
+        f"Someone from {practice_name} will contact you.",
+        state,
+    )
+
+
+@lru_cache(maxsize=128)
+def handoff_ack(practice_name: str) -> str:
+    return f"Thanks — your request is with the team at {practice_name}."
+
+
+def handle_handoff(practice_name: str, user_text: str, state: SessionStateDC) -> tuple[str, SessionStateDC]:
+    return handoff_ack(practice_name), state
+
+
+StepHandler = Callable[[str, str, SessionStateDC], tuple[str, SessionStateDC]]
+
+STEP_HANDLERS: Dict[Step, StepHandler] = {
+    Step.LIMITED_RESPONSE: handle_collect,
+    Step.COLLECT_CONTACT: handle_collect,
+    Step.HANDOFF: handle_handoff,
+}
+
+
+def next_reply(practice_name: str, user_text: str, state: SessionStateDC) -> tuple[str, SessionStateDC]:
+    if is_medical_or_medication_question(user_text):
+        state.step = Step.LIMITED_RESPONSE
+        return limited_response_policy(practice_name), state
+
+    return STEP_HANDLERS[state.step](practice_name, user_text, state)
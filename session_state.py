@@ -0,0 +1,33 @@
+"""Session state types shared by the state machine and the web layer."""
+
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Optional
+
+
+# ---------------------------
+# State machine models
+# ---------------------------
+
+class Step(str, Enum):
+    LIMITED_RESPONSE = "LIMITED_RESPONSE"
+    COLLECT_CONTACT = "COLLECT_CONTACT"
+    HANDOFF = "HANDOFF"
+
+
+# Internal session state: slotted dataclasses are far smaller than BaseModel
+# instances and are what SESSION_DB holds. msgspec decodes inbound state
+# straight into them.
+@dataclass(slots=True)
+class CollectedDC:
+    name: Optional[str] = None
+    phone: Optional[str] = None
+    best_time: Optional[str] = None
+
+
+@dataclass(slots=True)
+class SessionStateDC:
+    step: Step = Step.LIMITED_RESPONSE
+    procedure: Optional[str] = None
+    intent: Optional[str] = None
+    collected: CollectedDC = field(default_factory=CollectedDC)